@@ -1,23 +1,49 @@
 # app.py
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
-import requests
+from typing import Optional, List, Dict, Set, Any, Tuple, Callable, IO
+import httpx
 import random
 import os
+import sys
 import re
 import json
+import logging
+import orjson
 import html
+import asyncio
+import hashlib
+import numpy as np
+from collections import OrderedDict
 import google.generativeai as genai
 from dotenv import load_dotenv
 from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 
 # Load environment variables
 load_dotenv()
 
-app = FastAPI(title="Quran Mood Agent (FastAPI)")
+app = FastAPI(title="Quran Mood Agent (FastAPI)", default_response_class=ORJSONResponse)
+
+# DEBUG turns on debug logging (payloads, prompts, Gemini output); otherwise
+# only warnings and errors are written unless LOG_LEVEL says otherwise
+DEBUG = bool(os.environ.get("DEBUG"))
+# the level is also handed to uvicorn, so only its level names are accepted
+LOG_LEVELS = {"critical": logging.CRITICAL, "error": logging.ERROR, "warning": logging.WARNING,
+              "info": logging.INFO, "debug": logging.DEBUG, "trace": 5}
+REQUESTED_LOG_LEVEL = os.environ.get("LOG_LEVEL") or ("debug" if DEBUG else "warning")
+LOG_LEVEL = REQUESTED_LOG_LEVEL.lower() if REQUESTED_LOG_LEVEL.lower() in LOG_LEVELS else "warning"
+logging.basicConfig(
+    level=LOG_LEVELS[LOG_LEVEL],
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+)
+log = logging.getLogger("quran")
+logging.getLogger("httpx").setLevel(logging.WARNING) # skip its per-request INFO lines
+if LOG_LEVEL != REQUESTED_LOG_LEVEL.lower():
+    log.warning("LOG_LEVEL %r is not one of %s; using warning", REQUESTED_LOG_LEVEL, ", ".join(LOG_LEVELS))
 
 # Add CORS middleware
 origins = ["*"] # Allows all origins
@@ -32,19 +58,19 @@ app.add_middleware(
 # Configure Gemini API
 gemini_api_key = os.environ.get("GEMINI_API_KEY")
 if not gemini_api_key:
-    print("Error: GEMINI_API_KEY environment variable not set.")
-    print("Please set it in your .env file or as an environment variable.")
+    log.error("GEMINI_API_KEY environment variable not set. Please set it in your .env file or as an environment variable.")
     raise SystemExit(1)
 
 genai.configure(api_key=gemini_api_key)
-model = genai.GenerativeModel(
-    'gemini-2.5-flash',
-    system_instruction=(
-        "You are a compassionate and knowledgeable Quranic assistant. Your primary "
-        "goal is to provide comfort, guidance, and relevant Quranic verses to users "
-        "based on their emotional state. Keep responses empathetic and concise."
-    )
+GEMINI_MODEL_NAME = "gemini-2.5-flash"
+SYSTEM_INSTRUCTION = (
+    "You are a compassionate and knowledgeable Quranic assistant. Your primary "
+    "goal is to provide comfort, guidance, and relevant Quranic verses to users "
+    "based on their emotional state. Keep responses empathetic and concise."
 )
+model = genai.GenerativeModel(GEMINI_MODEL_NAME, system_instruction=SYSTEM_INSTRUCTION)
+# Not served from Gemini's context cache: it only caches contexts above a minimum
+# token count, which SYSTEM_INSTRUCTION is far short of.
 
 # Simple mood mapping
 MOOD_MAPPING = {
@@ -65,20 +91,106 @@ MOOD_MAPPING = {
     "inspired": ["creation", "signs", "knowledge"]
 }
 
+# Static health check body, built once and cacheable by probes/proxies
+HEALTH_BODY = orjson.dumps({"status": "running", "service": "Quran Mood Agent"})
+HEALTH_HEADERS = {"Cache-Control": "public, max-age=30"}
+
+# Response headers marking whether /agent and /stream answered from the response cache
+CACHE_HIT_HEADERS = {"X-Cache": "HIT", "Cache-Control": "private, max-age=60"}
+CACHE_MISS_HEADERS = {"X-Cache": "MISS"}
+
+# Inbound text longer than this is HTML-cleaned in a worker thread
+CLEAN_HTML_THREADPOOL_THRESHOLD = 4096
+
+# Opening words treated as a greeting
+_GREETINGS = frozenset({"hello", "hi", "hey", "hiya", "salam", "salaam", "assalamu"})
+
+# Precompiled patterns for the per-request text handling
+_WS_RE = re.compile(r"\s+")
+# the whole (normalized) message must be the question, so "who are you to tell me..." still gets a verse
+_WHOAMI_RE = re.compile(r"(?:who are you|what are you|what do you do)[?.! ]*")
+_TOKEN_RE = re.compile(r"[a-z]+")
+
+# Mood names, interned since they end up as keys and values in the caches
+_MOOD_KEYS = tuple(sys.intern(k) for k in MOOD_MAPPING)
+_MOOD_SET = frozenset(_MOOD_KEYS)
+# whole-word MOOD_MAPPING keywords per mood, for matching lowercased verse translations
+_MOOD_KEYWORD_RES = {
+    mood: re.compile(r"\b(?:" + "|".join(k.lower() for k in keywords) + r")\b")
+    for mood, keywords in MOOD_MAPPING.items()
+}
+
+# Structured output for the single mood + verse call; the enum keeps Gemini to known moods
+MOOD_VERSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "mood": {"type": "string", "enum": [*_MOOD_KEYS, "unknown"]},
+        "verse": {"type": "string"},
+        "explanation": {"type": "string"},
+    },
+    "required": ["mood", "verse", "explanation"],
+}
+
 QURAN_API_BASE_URL = "http://api.alquran.cloud/v1"
+QURAN_SURAH_COUNT = 114
+QURAN_AYAH_COUNT = 6236
+
+QURAN_TRANSLATION_EDITION = "en.sahih"
+NO_QUOTE_REPLY = "I'm sorry, I couldn't fetch a Quran quote at this moment. Please try again later."
+
+# Verse pool files, built once and reused by later startups
+VERSES_PATH = os.environ.get("VERSES_PATH", "verses.json")
+VERSE_EMBEDDINGS_PATH = os.environ.get("VERSE_EMBEDDINGS_PATH", "verse_embeddings.npy")
+EMBEDDING_BATCH_SIZE = 100 # texts per embed_content request
+
+# Detected moods for recently seen messages, keyed on message_digest so message
+# size doesn't matter; least recently used first
+MOOD_CACHE_MAX_ENTRIES = 4096
+MOOD_CACHE: "OrderedDict[str, str]" = OrderedDict()
+
+# Mood detection micro-batching (only kicks in under concurrent load)
+MOOD_BATCH_SIZE = 8
+MOOD_BATCH_WINDOW = 0.015 # seconds to wait for more texts after the first
+MOOD_BATCH_MIN_INFLIGHT = 2 # concurrent detections needed before batching
+
+# Semantic response cache settings
+EMBEDDING_MODEL = "models/text-embedding-004"
+SEMANTIC_CACHE_THRESHOLD = 0.92 # cosine similarity needed for a hit
+SEMANTIC_CACHE_MAX_ENTRIES = 10_000
+SEMANTIC_CACHE_PATH = os.environ.get("SEMANTIC_CACHE_PATH", "semantic_cache.npz")
+
+# Shared async HTTP client (pooled keep-alive connections, reused across requests).
+# The transport retries failed connects; quran_api_get retries gateway errors.
+QURAN_API_RETRIES = 2
+QURAN_API_RETRY_STATUSES = frozenset({502, 503, 504})
+HTTP_CLIENT = httpx.AsyncClient(
+    base_url=QURAN_API_BASE_URL,
+    timeout=httpx.Timeout(5.0, connect=2.0),
+    transport=httpx.AsyncHTTPTransport(
+        retries=QURAN_API_RETRIES,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    ),
+)
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await HTTP_CLIENT.aclose()
+
+
+async def quran_api_get(path: str) -> httpx.Response:
+    for attempt in range(QURAN_API_RETRIES + 1):
+        response = await HTTP_CLIENT.get(path)
+        if response.status_code not in QURAN_API_RETRY_STATUSES or attempt == QURAN_API_RETRIES:
+            break
+        await asyncio.sleep(0.1 * 2 ** attempt)
+    response.raise_for_status()
+    return response
 
 
 # -------------------------
 # Pydantic Generic models
 # -------------------------
-class TelexInputMessage(BaseModel): # Retained for generic parsing compatibility
-    kind: str
-    role: Optional[str] = None
-    content: Optional[str] = None
-
-class SimpleMessageInput(BaseModel): # Retained for generic parsing compatibility
-    message: str
-
 class GenericResponse(BaseModel):
     response: str
     mood: str
@@ -128,43 +240,229 @@ class TelexRpcErrorResponse(BaseModel):
 # -------------------------
 # Utilities
 # -------------------------
-def pretty_log(title: str, data: Any):
+def model_response(body: BaseModel, status_code: int = 200, headers: Optional[Dict[str, str]] = None) -> Response:
+    # pydantic writes the JSON directly, skipping the intermediate dict
+    return Response(content=body.model_dump_json(), status_code=status_code, media_type="application/json", headers=headers)
+
+
+def write_file_atomic(path: str, write: Callable[[IO[bytes]], None]) -> None:
+    # workers share the data files: write a temp file and rename it into place
+    # so a reader never sees a half-written file
+    tmp = f"{path}.{os.getpid()}.tmp"
     try:
-        print("\n" + "=" * 60)
-        print(f"📥 {title}")
-        print("=" * 60)
-        print(json.dumps(data, indent=4, ensure_ascii=False))
-        print("=" * 60 + "\n")
-    except Exception as e:
-        print("pretty_log error:", e)
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def sse_event(data: Dict[str, Any]) -> bytes:
+    return b"data: " + orjson.dumps(data) + b"\n\n"
+
+
+def normalize_text(text: str) -> str:
+    # computed once per message and passed to the greeting check and the caches
+    return _WS_RE.sub(" ", text).strip().lower()
+
+
+def message_digest(normalized: str) -> str:
+    # fixed-size cache key for a normalized message
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
 
 
 def clean_html_text(raw: Optional[str]) -> str:
     if not raw:
         return ""
     unescaped = html.unescape(raw)
-    soup = BeautifulSoup(unescaped, "html.parser")
-    cleaned = soup.get_text(separator=" ", strip=True)
-    cleaned = cleaned.replace("\xa0", " ").strip()
-    cleaned = re.sub(r"\s+", " ", cleaned)
-    return cleaned
+    if "<" not in unescaped:
+        # plain text, nothing to parse
+        cleaned = unescaped
+    else:
+        try:
+            cleaned = LexborHTMLParser(unescaped).text(separator=" ", strip=True)
+        except Exception as e:
+            log.warning("clean_html_text selectolax error: %s", e)
+            cleaned = BeautifulSoup(unescaped, "html.parser").get_text(separator=" ", strip=True)
+    # \s also matches \xa0, so one pass turns non-breaking spaces into plain ones too
+    return _WS_RE.sub(" ", cleaned).strip()
+
+
+async def clean_html_async(raw: Optional[str]) -> str:
+    # large payloads are parsed off the event loop so they don't stall other requests
+    if raw and len(raw) > CLEAN_HTML_THREADPOOL_THRESHOLD:
+        return await run_in_threadpool(clean_html_text, raw)
+    return clean_html_text(raw)
+
+
+# -------------------------
+# Verse pool
+# -------------------------
+class VersePool:
+    """
+    Every ayah stored column-wise (struct of arrays): a random pick is a
+    single index, and finding verses for a message is one matrix-vector
+    product against the unit-length translation embeddings. mood_index holds,
+    per mood, the ayahs whose translation mentions one of its MOOD_MAPPING keywords.
+    """
+
+    def __init__(self):
+        self.names = np.empty(0, dtype=object)
+        self.nums = np.empty(0, dtype=np.int16)
+        self.texts = np.empty(0, dtype=object)
+        self.translations = np.empty(0, dtype=object)
+        self.embeddings: Optional[np.ndarray] = None # (N, dim) float32
+        self.mood_index: Dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def fill(self, ayahs: List[Tuple[str, int, str, str]]) -> None:
+        self.names = np.array([a[0] for a in ayahs], dtype=object)
+        self.nums = np.array([a[1] for a in ayahs], dtype=np.int16)
+        self.texts = np.array([a[2] for a in ayahs], dtype=object)
+        self.translations = np.array([a[3] for a in ayahs], dtype=object)
+        self.embeddings = None
+        lowered = [t.lower() for t in self.translations]
+        self.mood_index = {
+            mood: np.array([i for i, t in enumerate(lowered) if pattern.search(t)], dtype=np.int32)
+            for mood, pattern in _MOOD_KEYWORD_RES.items()
+        }
+
+    def rows(self) -> List[Tuple[str, int, str, str]]:
+        return list(zip(self.names.tolist(), self.nums.tolist(), self.texts.tolist(), self.translations.tolist()))
+
+    def random_quote(self, mood: Optional[str] = None) -> str:
+        # prefer a verse matching the mood's keywords when there is one
+        candidates = self.mood_index.get(mood)
+        if candidates is not None and len(candidates):
+            i = random.choice(candidates)
+        else:
+            i = random.randrange(len(self.texts))
+        return f'"{self.texts[i]}" (Quran {self.names[i]}:{self.nums[i]})'
 
+    def find_verses_for_mood(self, vector: np.ndarray, k: int = 5) -> np.ndarray:
+        """Indices of the k verses closest to the (unit-length) vector, best first."""
+        scores = self.embeddings @ vector
+        k = min(k, len(scores))
+        idx = np.argpartition(-scores, k - 1)[:k]
+        return idx[np.argsort(-scores[idx])]
 
-def get_random_quran_quote() -> str:
+    def pick_verse_for(self, vector: np.ndarray) -> str:
+        """One of the closest verses, formatted as 'Surah:Ayah - translation'."""
+        i = random.choice(self.find_verses_for_mood(vector))
+        return f"{self.names[i]}:{self.nums[i]} - {self.translations[i]}"
+
+
+VERSES = VersePool()
+
+
+def load_verse_file() -> None:
+    if not os.path.exists(VERSES_PATH):
+        return
     try:
-        surah_num = random.randint(1, 114)
-        response = requests.get(f"{QURAN_API_BASE_URL}/surah/{surah_num}")
-        response.raise_for_status()
-        surah_data = response.json()
-        ayahs = surah_data["data"]["ayahs"]
-        random_ayah = random.choice(ayahs)
-        text = random_ayah["text"]
-        surah_name = surah_data["data"]["englishName"]
-        ayah_number = random_ayah["numberInSurah"]
+        with open(VERSES_PATH, encoding="utf-8") as f:
+            VERSES.fill(json.load(f))
+    except Exception as e:
+        log.error("load_verse_file error: %s", e)
+
+
+# a bundled or previously downloaded verse file is loaded at import; startup only downloads when it's missing
+load_verse_file()
+
+
+async def fetch_ayah(number: int) -> Tuple[str, int, str]:
+    """One ayah by its global number (1..QURAN_AYAH_COUNT)."""
+    response = await quran_api_get(f"/ayah/{number}")
+    ayah = response.json()["data"]
+    return ayah["surah"]["englishName"], ayah["numberInSurah"], ayah["text"]
+
+
+async def fetch_surah_with_translation(surah_num: int) -> List[Tuple[str, int, str, str]]:
+    response = await quran_api_get(f"/surah/{surah_num}/editions/quran-uthmani,{QURAN_TRANSLATION_EDITION}")
+    arabic, translation = response.json()["data"]
+    surah_name = arabic["englishName"]
+    return [
+        (surah_name, ayah["numberInSurah"], ayah["text"], translated["text"])
+        for ayah, translated in zip(arabic["ayahs"], translation["ayahs"])
+    ]
+
+
+async def load_verse_pool():
+    """
+    Fill VERSES when VERSES_PATH wasn't available at import, downloading all
+    surahs (concurrently) and writing the file. The Quran is static, so this
+    replaces a per-fallback API round-trip with an in-memory random pick.
+    """
+    if len(VERSES):
+        return
+    try:
+        surahs = await asyncio.gather(
+            *(fetch_surah_with_translation(n) for n in range(1, QURAN_SURAH_COUNT + 1))
+        )
+        VERSES.fill([ayah for surah in surahs for ayah in surah])
+        write_file_atomic(VERSES_PATH, lambda f: f.write(orjson.dumps(VERSES.rows())))
+    except Exception as e:
+        log.error("load_verse_pool error: %s", e)
+
+
+async def load_verse_embeddings():
+    """
+    Embed every translation (batched, sequentially to stay inside the
+    embedding rate limit) and cache the matrix at VERSE_EMBEDDINGS_PATH.
+    """
+    try:
+        if not len(VERSES):
+            return
+        if os.path.exists(VERSE_EMBEDDINGS_PATH):
+            embeddings = np.load(VERSE_EMBEDDINGS_PATH)
+            if embeddings.shape[0] == len(VERSES):
+                VERSES.embeddings = embeddings
+                return
+        batches = []
+        for start in range(0, len(VERSES), EMBEDDING_BATCH_SIZE):
+            batch = VERSES.translations[start:start + EMBEDDING_BATCH_SIZE].tolist()
+            result = await genai.embed_content_async(model=EMBEDDING_MODEL, content=batch)
+            batches.append(np.asarray(result["embedding"], dtype=np.float32))
+        embeddings = np.vstack(batches)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        write_file_atomic(VERSE_EMBEDDINGS_PATH, lambda f: np.save(f, embeddings))
+        VERSES.embeddings = np.ascontiguousarray(embeddings)
+    except Exception as e:
+        log.error("load_verse_embeddings error: %s", e)
+
+
+@app.on_event("startup")
+async def preload_verse_pool():
+    await load_verse_pool()
+    # embedding the whole pool can take a while on first run, so don't hold up startup
+    app.state.verse_embeddings_task = asyncio.create_task(load_verse_embeddings())
+
+
+async def prepare_verse_files():
+    """
+    Download and embed the verse pool once, before worker processes start, so
+    they load the files instead of each fetching all surahs and re-embedding them.
+    """
+    await load_verse_pool()
+    await load_verse_embeddings()
+    await HTTP_CLIENT.aclose()
+
+
+async def get_random_quran_quote(mood: Optional[str] = None) -> Optional[str]:
+    """A random verse, or None when neither the pool nor the live API has one."""
+    try:
+        if len(VERSES):
+            return VERSES.random_quote(mood)
+        # pool failed to load, fall back to a live fetch
+        # by global ayah number, so long surahs aren't under-sampled
+        surah_name, ayah_number, text = await fetch_ayah(random.randint(1, QURAN_AYAH_COUNT))
         return f'"{text}" (Quran {surah_name}:{ayah_number})'
     except Exception as e:
-        print("get_random_quran_quote error:", e)
-        return "I'm sorry, I couldn't fetch a Quran quote at this moment. Please try again later."
+        log.error("get_random_quran_quote error: %s", e)
+        return None
 
 
 # -------------------------
@@ -218,134 +516,625 @@ def extract_user_message_generic(payload: Dict[str, Any]) -> str:
         if "text" in payload and isinstance(payload["text"], str):
             return clean_html_text(payload["text"])
 
-        # 4) scan whole payload for dicts with 'text'
-        def collect_texts(obj):
-            found = []
-            if obj is None:
-                return found
+        # 4) scan whole payload for the last dict 'text' value.
+        # Children are pushed in order, so popping walks the payload back to front
+        # and the first 'text' reached is the last one in document order.
+        stack: List[Any] = [payload]
+        while stack:
+            obj = stack.pop()
+            if isinstance(obj, tuple): # a ("text", value) leaf
+                return clean_html_text(obj[1])
             if isinstance(obj, dict):
                 for k, v in obj.items():
                     if k == "text" and isinstance(v, str) and v.strip():
-                        found.append(v)
-                    else:
-                        found.extend(collect_texts(v))
+                        stack.append((k, v))
+                    elif isinstance(v, (dict, list)):
+                        stack.append(v)
             elif isinstance(obj, list):
-                for item in obj:
-                    found.extend(collect_texts(item))
-            return found
-
-        all_texts = collect_texts(payload)
-        if all_texts:
-            return clean_html_text(all_texts[-1])
+                stack.extend(item for item in obj if isinstance(item, (dict, list)))
 
         return ""
     except Exception as e:
-        print("extract_user_message_generic error:", e)
+        log.error("extract_user_message_generic error: %s", e)
         return ""
 
 
+async def extract_agent_message(request_body: Any) -> str:
+    """Message text from a generic (non-JSON-RPC) payload, as sent to /agent and /stream."""
+    # Try structured shapes first (plain dict checks, no validation exceptions)
+    is_dict = isinstance(request_body, dict)
+    # 1) {"kind": ..., "content": "..."} shape
+    if is_dict and isinstance(request_body.get("kind"), str) and isinstance(request_body.get("content"), str) and request_body["content"]:
+        return await clean_html_async(request_body["content"])
+    # 2) {"message": "..."} shape
+    if is_dict and isinstance(request_body.get("message"), str):
+        return await clean_html_async(request_body["message"])
+    # 3) Generic extractor fallback
+    return extract_user_message_generic(request_body)
+
+
 # -------------------------
 # Gemini helpers
 # -------------------------
-def get_smart_quran_response(mood: str, user_message: str) -> str:
+# identical prompts currently waiting on Gemini, keyed on (prompt, generation config)
+_INFLIGHT: Dict[Tuple[str, bytes], asyncio.Future] = {}
+
+
+def _retrieve_exception(future: asyncio.Future) -> None:
+    # if every caller was cancelled nobody reads the error; mark it retrieved so
+    # asyncio doesn't log "exception was never retrieved"
+    if not future.cancelled():
+        future.exception()
+
+
+async def generate_content_shared(prompt: str, generation_config: Optional[Dict[str, Any]] = None):
+    """
+    model.generate_content_async, except concurrent identical requests share
+    one upstream call. The call is shielded so a disconnecting caller
+    doesn't cancel it for the others.
+    """
+    key = (prompt, orjson.dumps(generation_config))
+    future = _INFLIGHT.get(key)
+    if future is None:
+        future = asyncio.ensure_future(model.generate_content_async(prompt, generation_config=generation_config))
+        _INFLIGHT[key] = future
+        future.add_done_callback(lambda _: _INFLIGHT.pop(key, None))
+        future.add_done_callback(_retrieve_exception)
+    return await asyncio.shield(future)
+
+
+async def warm_up_gemini():
+    # one-token generation and a tiny embedding, so the channel and auth are
+    # set up before the first real request pays for them
     try:
-        prompt_direct_verse = (
-            f"The user is feeling {mood} because they said: \"{user_message}\".\n"
-            "Provide a highly relevant Quranic verse (Surah:Ayah) and a brief explanation of how it addresses their mood.\n"
-            "If you cannot find a specific verse, just say 'NO_VERSE_FOUND'.\n"
-            "Format your response strictly as:\n"
-            "Verse: [Surah:Ayah] - [English Translation]\n"
-            "Explanation: [Your explanation]"
+        await asyncio.gather(
+            model.generate_content_async("ping", generation_config={"max_output_tokens": 1}),
+            genai.embed_content_async(model=EMBEDDING_MODEL, content="ping"),
         )
-        print("--- PROMPT FOR VERSE ---")
-        print(prompt_direct_verse)
-        response_direct = model.generate_content(prompt_direct_verse)
-        gemini_output = response_direct.text.strip()
-        print("--- GEMINI OUTPUT ---")
-        print(gemini_output)
-
-        if "NO_VERSE_FOUND" not in gemini_output and "Verse:" in gemini_output and "Explanation:" in gemini_output:
-            return gemini_output
-
-        # fallback
-        random_quote = get_random_quran_quote()
-        prompt_explain_random = (
-            f"The user is feeling {mood} because they said: \"{user_message}\".\n"
-            f"Here is a Quranic verse: {random_quote}.\n"
-            "Explain how this verse can be relevant or comforting to someone feeling {mood}.\n"
-            "Format your response strictly as:\n"
-            f"Verse: {random_quote}\nExplanation:"
+    except Exception as e:
+        log.warning("warm_up_gemini error: %s", e)
+
+
+@app.on_event("startup")
+async def start_gemini_warmup():
+    # runs in each worker; in the background so startup doesn't wait on Gemini
+    app.state.gemini_warmup_task = asyncio.create_task(warm_up_gemini())
+
+
+def build_explain_prompt(mood: str, user_message: str, verse: str) -> str:
+    return (
+        f"The user is feeling {mood} because they said: \"{user_message}\".\n"
+        f"Here is a Quranic verse: {verse}.\n"
+        f"Explain how this verse can be relevant or comforting to someone feeling {mood}.\n"
+        "Format your response strictly as:\n"
+        f"Verse: {verse}\nExplanation:"
+    )
+
+
+def format_verse_response(verse: str, explanation: str) -> str:
+    return f"Verse: {verse}\nExplanation: {explanation}"
+
+
+async def ask_gemini_for_mood_and_verse(user_message: str, vector: Optional[np.ndarray] = None) -> Tuple[str, str, str]:
+    """
+    Mood detection and verse generation in one structured Gemini call.
+    Returns (mood, verse, explanation); verse is empty when Gemini found none.
+    With verse embeddings loaded, Gemini chooses among the closest ayahs.
+    """
+    if vector is not None and VERSES.embeddings is not None:
+        candidates = "\n".join(
+            f"- {VERSES.names[i]}:{VERSES.nums[i]} - {VERSES.translations[i]}"
+            for i in VERSES.find_verses_for_mood(vector)
         )
-        response_explain = model.generate_content(prompt_explain_random)
-        return response_explain.text.strip()
+        verse_instruction = f"Choose the most relevant of these Quranic verses and copy it exactly:\n{candidates}\n"
+    else:
+        verse_instruction = "Provide a highly relevant Quranic verse as 'Surah:Ayah - English Translation', or an empty string if you cannot find one.\n"
+    prompt = (
+        f"The user said: \"{user_message}\".\n"
+        f"Identify the primary mood expressed, as one of: {', '.join(_MOOD_KEYS)}; use 'unknown' if it is unclear or neutral.\n"
+        f"{verse_instruction}"
+        "Then briefly explain how the verse addresses their mood."
+    )
+    log.debug("--- PROMPT FOR MOOD AND VERSE ---\n%s", prompt)
+    response = await generate_content_shared(
+        prompt,
+        generation_config={"response_mime_type": "application/json", "response_schema": MOOD_VERSE_SCHEMA},
+    )
+    log.debug("--- GEMINI OUTPUT ---\n%s", response.text)
+    answer = json.loads(response.text)
+    mood = str(answer.get("mood", "")).lower()
+    mood = sys.intern(mood) if mood in _MOOD_SET else "unknown"
+    return mood, str(answer.get("verse", "")).strip(), str(answer.get("explanation", "")).strip()
+
 
+async def explain_random_quote(mood: str, user_message: str) -> Tuple[str, bool]:
+    """
+    Fallback when Gemini didn't supply a verse: explain a random one.
+    Returns (response_text, complete); complete is False for the apology
+    returned when there is no verse or Gemini fails, so callers know not to cache it.
+    """
+    random_quote = await get_random_quran_quote(mood)
+    if random_quote is None:
+        return NO_QUOTE_REPLY, False
+    try:
+        response_explain = await generate_content_shared(build_explain_prompt(mood, user_message, random_quote))
+        return response_explain.text.strip(), True
     except Exception as e:
-        print("get_smart_quran_response error:", e)
-        fallback = get_random_quran_quote()
-        return f"I'm sorry — couldn't get a tailored verse. Here's something to reflect on: {fallback}"
+        log.error("explain_random_quote error: %s", e)
+        return f"I'm sorry — couldn't get a tailored verse. Here's something to reflect on: {random_quote}", False
+
+
+async def pick_local_verse(mood: str, vector: Optional[np.ndarray] = None) -> Optional[str]:
+    """Closest verse by embedding, else a random one; None when there is no verse."""
+    if vector is not None and VERSES.embeddings is not None:
+        return VERSES.pick_verse_for(vector)
+    return await get_random_quran_quote(mood)
+
+
+async def stream_smart_quran_response(mood: str, user_message: str, verse: str):
+    """
+    Streams the explanation for /stream, where the mood is already known.
+    The verse is picked locally so Gemini only has to stream the explanation.
+    """
+    response = await model.generate_content_async(build_explain_prompt(mood, user_message, verse), stream=True)
+    async for chunk in response:
+        yield chunk.text
+
+
+def remember_mood(key: str, mood: str) -> str:
+    MOOD_CACHE[key] = mood
+    if len(MOOD_CACHE) > MOOD_CACHE_MAX_ENTRIES:
+        MOOD_CACHE.popitem(last=False)
+    return mood
+
+
+def parse_mood(response_text: str) -> str:
+    # first word of Gemini's (lowercased) answer that names a known mood;
+    # whole tokens, so "unhappy" doesn't read as "happy"
+    mood = next((t for t in _TOKEN_RE.findall(response_text) if t in _MOOD_SET), None)
+    return sys.intern(mood) if mood else "unknown"
+
+
+async def ask_gemini_for_mood(text: str) -> str:
+    prompt = (
+        f"Analyze the following text and identify the primary mood expressed. "
+        f"Respond with a single word (e.g., happy, sad, anxious, angry, grateful, stressed, hopeful, fearful, calm, lonely, confused, motivated, tired, thankful, inspired). "
+        f"If the mood is unclear or neutral, respond with 'unknown'.\n\nText: '{text}'\nMood:"
+    )
+    log.debug("--- PROMPT FOR MOOD ---\n%s", prompt)
+    response = await generate_content_shared(prompt)
+    response_text = response.text.strip().lower()
+    log.debug("--- GEMINI MOOD OUTPUT ---\n%s", response_text)
+
+    return parse_mood(response_text)
+
+
+async def ask_gemini_for_moods(texts: List[str]) -> List[str]:
+    numbered = "\n".join(f"### Text {i}: '{text}'" for i, text in enumerate(texts, 1))
+    prompt = (
+        f"Analyze each of the following {len(texts)} texts and identify the primary mood expressed in each. "
+        f"For each text use a single word (e.g., happy, sad, anxious, angry, grateful, stressed, hopeful, fearful, calm, lonely, confused, motivated, tired, thankful, inspired), "
+        f"or 'unknown' if the mood is unclear or neutral. "
+        f"Respond with a JSON list of {len(texts)} strings, in order.\n\n{numbered}"
+    )
+    response = await generate_content_shared(
+        prompt, generation_config={"response_mime_type": "application/json"}
+    )
+    answers = json.loads(response.text)
+    if not isinstance(answers, list) or len(answers) != len(texts):
+        raise ValueError(f"expected {len(texts)} moods, got: {response.text!r}")
+    return [parse_mood(str(answer).lower()) for answer in answers]
 
 
-def detect_mood_with_gemini(text: str) -> str:
+class MoodBatcher:
+    """
+    Coalesces concurrent mood detections into one multi-text Gemini prompt.
+    While fewer than MOOD_BATCH_MIN_INFLIGHT detections are running, texts go
+    straight to Gemini so a lone user never waits on the batching window.
+    """
+
+    def __init__(self, max_size: int = MOOD_BATCH_SIZE, window: float = MOOD_BATCH_WINDOW,
+                 min_inflight: int = MOOD_BATCH_MIN_INFLIGHT):
+        self.max_size = max_size
+        self.window = window
+        self.min_inflight = min_inflight
+        self.inflight = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._submits: Set[asyncio.Task] = set() # the loop only keeps weak references to tasks
+
+    async def detect(self, text: str) -> str:
+        self.inflight += 1
+        try:
+            if self.inflight < self.min_inflight:
+                return await ask_gemini_for_mood(text)
+            if self._worker is None or self._worker.done():
+                self._queue = asyncio.Queue()
+                self._worker = asyncio.create_task(self._run())
+            future = asyncio.get_running_loop().create_future()
+            await self._queue.put((text, future))
+            return await future
+        finally:
+            self.inflight -= 1
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # submit in the background so the next batch can start filling
+            task = asyncio.create_task(self._submit(batch))
+            self._submits.add(task)
+            task.add_done_callback(self._submits.discard)
+
+    async def _submit(self, batch: List[Tuple[str, asyncio.Future]]):
+        texts = [text for text, _ in batch]
+        try:
+            moods = await ask_gemini_for_moods(texts)
+        except Exception as e:
+            log.warning("MoodBatcher batch error: %s", e)
+            moods = await asyncio.gather(*(ask_gemini_for_mood(text) for text in texts), return_exceptions=True)
+        for (_, future), mood in zip(batch, moods):
+            if future.done():
+                continue
+            if isinstance(mood, Exception):
+                future.set_exception(mood)
+            else:
+                future.set_result(mood)
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+        # let batches already sent to Gemini resolve their callers
+        await asyncio.gather(*self._submits, return_exceptions=True)
+
+
+MOOD_BATCHER = MoodBatcher()
+
+
+@app.on_event("shutdown")
+async def close_mood_batcher():
+    await MOOD_BATCHER.close()
+
+
+async def detect_mood_with_gemini(text: str) -> str:
+    # text is the normalized message
+    key = message_digest(text)
+    cached = MOOD_CACHE.get(key)
+    if cached is not None:
+        MOOD_CACHE.move_to_end(key)
+        return cached
     try:
-        prompt = (
-            f"Analyze the following text and identify the primary mood expressed. "
-            f"Respond with a single word (e.g., happy, sad, anxious, angry, grateful, stressed, hopeful, fearful, calm, lonely, confused, motivated, tired, thankful, inspired). "
-            f"If the mood is unclear or neutral, respond with 'unknown'.\n\nText: '{text}'\nMood:"
-        )
-        print("--- PROMPT FOR MOOD ---")
-        print(prompt)
-        response = model.generate_content(prompt)
-        response_text = response.text.strip().lower()
-        print("--- GEMINI MOOD OUTPUT ---")
-        print(response_text)
-
-        for mood in MOOD_MAPPING.keys():
-            if mood in response_text:
-                return mood
-        return "unknown"
+        return remember_mood(key, await MOOD_BATCHER.detect(text))
     except Exception as e:
-        print("detect_mood_with_gemini error:", e)
+        # errors aren't cached so the next attempt retries Gemini
+        log.error("detect_mood_with_gemini error: %s", e)
         return "unknown"
 
 
 # -------------------------
-# Core Logic Functions
+# Response cache
 # -------------------------
-async def handle_message_send(params: TelexRpcParams) -> TelexRpcResult:
-    user_message = ""
-    # Extract user message from TelexRpcParams
-    if params.message and params.message.parts:
-        for part in params.message.parts:
-            if part.type == "text" and part.text:
-                user_message = clean_html_text(part.text)
-                break # Take the first text part
+class SemanticCache:
+    """
+    In-process cache of (mood, response) pairs for messages we've already answered.
+    - Exact layer: sha1 of the normalized message -> row, no embedding needed
+    - Semantic layer: cosine similarity of the message embedding against all
+      cached embeddings in a single matrix-vector product. The matrix stays
+      float32 in memory (NumPy has no fast int8 product); the saved file holds
+      int8 rows with a per-row scale, a quarter of the size.
+    Least recently used rows are overwritten once max_entries is reached.
+    """
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._vectors: Optional[np.ndarray] = None # (capacity, dim), unit-length rows
+        self._entries: List[Tuple[str, str]] = []
+        self._digests: List[str] = []
+        self._rows: Dict[str, int] = {}
+        self._recency: "OrderedDict[int, None]" = OrderedDict() # rows, least recently used first
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def quantize(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # int8 rows and the per-row scale that maps them back (row ≈ q / scale)
+        scales = 127.0 / np.maximum(np.abs(vectors).max(axis=1), 1e-12)
+        return np.round(vectors * scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    @staticmethod
+    def digest(normalized: str) -> str:
+        return message_digest(normalized)
+
+    def _touch(self, row: int) -> Tuple[str, str]:
+        self._recency[row] = None
+        self._recency.move_to_end(row)
+        return self._entries[row]
+
+    def get_exact(self, normalized: str) -> Optional[Tuple[str, str]]:
+        row = self._rows.get(self.digest(normalized))
+        return None if row is None else self._touch(row)
+
+    def get_similar(self, vector: np.ndarray) -> Optional[Tuple[str, str]]:
+        if not self._entries:
+            return None
+        scores = self._vectors[:len(self._entries)] @ vector
+        row = int(np.argmax(scores))
+        if scores[row] < self.threshold:
+            return None
+        return self._touch(row)
+
+    def put(self, normalized: str, vector: np.ndarray, mood: str, response: str) -> None:
+        digest = self.digest(normalized)
+        row = self._rows.get(digest)
+        if row is None and len(self._entries) >= self.max_entries:
+            # evict the least recently used row and reuse its slot
+            row = next(iter(self._recency))
+            del self._rows[self._digests[row]]
+        if row is None:
+            row = len(self._entries)
+            self._grow(row + 1, vector.shape[0])
+            self._entries.append((mood, response))
+            self._digests.append(digest)
+        else:
+            self._entries[row] = (mood, response)
+            self._digests[row] = digest
+        self._vectors[row] = vector
+        self._rows[digest] = row
+        self._touch(row)
+
+    def _grow(self, size: int, dim: int) -> None:
+        if self._vectors is not None and self._vectors.shape[0] >= size:
+            return
+        capacity = min(max(size, 2 * len(self._entries), 64), self.max_entries)
+        vectors = np.zeros((capacity, dim), dtype=np.float32)
+        if self._vectors is not None:
+            vectors[:len(self._entries)] = self._vectors[:len(self._entries)]
+        self._vectors = vectors
+
+    def save(self, path: str) -> None:
+        if not self._entries:
+            return
+        order = list(self._recency) # oldest first, so reload keeps LRU order
+        vectors, scales = self.quantize(self._vectors[order])
+        write_file_atomic(path, lambda f: np.savez(
+            f,
+            vectors=vectors,
+            scales=scales,
+            digests=np.array([self._digests[i] for i in order]),
+            entries=np.array(json.dumps([self._entries[i] for i in order], ensure_ascii=False)),
+        ))
+
+    def load(self, path: str) -> None:
+        """Add the saved entries; ones already cached here are kept as they are."""
+        with np.load(path) as data:
+            vectors = data["vectors"]
+            digests = data["digests"].tolist()
+            entries = json.loads(str(data["entries"]))
+            # files saved before quantization hold float32 vectors and no scales
+            if "scales" in data:
+                vectors = vectors.astype(np.float32) / data["scales"][:, None]
+        for digest, vector, (mood, response) in zip(digests, vectors, entries):
+            if digest in self._rows:
+                continue
+            row = len(self._entries)
+            if row >= self.max_entries:
+                break
+            self._grow(row + 1, vector.shape[0])
+            self._vectors[row] = vector
+            self._entries.append((mood, response))
+            self._digests.append(digest)
+            self._rows[digest] = row
+            self._touch(row)
+
+
+RESPONSE_CACHE = SemanticCache()
+
+
+async def embed_text(text: str) -> Optional[np.ndarray]:
+    try:
+        result = await genai.embed_content_async(model=EMBEDDING_MODEL, content=text)
+        vector = np.asarray(result["embedding"], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+    except Exception as e:
+        log.error("embed_text error: %s", e)
+        return None
+
+
+async def lookup_cached_response(user_message: str, normalized: str) -> Tuple[Optional[Tuple[str, str]], Optional[np.ndarray]]:
+    """
+    Returns ((mood, response) or None, embedding or None).
+    The embedding is handed back so a miss can be cached without re-embedding.
+    """
+    cached = RESPONSE_CACHE.get_exact(normalized)
+    if cached:
+        return cached, None
+    vector = await embed_text(user_message)
+    if vector is None:
+        return None, None
+    return RESPONSE_CACHE.get_similar(vector), vector
+
+
+def cache_response(normalized: str, vector: Optional[np.ndarray], mood: str, response: str) -> None:
+    # only called with completed Gemini responses; skip when embedding failed
+    if vector is None:
+        return
+    RESPONSE_CACHE.put(normalized, vector, mood, response)
+
+
+@app.on_event("startup")
+async def load_response_cache():
+    if not os.path.exists(SEMANTIC_CACHE_PATH):
+        return
+    try:
+        RESPONSE_CACHE.load(SEMANTIC_CACHE_PATH)
+    except Exception as e:
+        log.error("load_response_cache error: %s", e)
+
 
+def merge_and_save_response_cache() -> None:
+    # every worker saves to the same file: under an exclusive lock, fold in what
+    # the others saved since startup so their entries aren't overwritten
+    try:
+        import fcntl
+    except ImportError:
+        # no flock (Windows): just replace the file with this worker's entries
+        RESPONSE_CACHE.save(SEMANTIC_CACHE_PATH)
+        return
+    with open(f"{SEMANTIC_CACHE_PATH}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(SEMANTIC_CACHE_PATH):
+            RESPONSE_CACHE.load(SEMANTIC_CACHE_PATH)
+        RESPONSE_CACHE.save(SEMANTIC_CACHE_PATH)
+
+
+@app.on_event("shutdown")
+async def save_response_cache():
+    try:
+        await run_in_threadpool(merge_and_save_response_cache)
+    except Exception as e:
+        log.error("save_response_cache error: %s", e)
+
+
+# -------------------------
+# Core Logic Functions
+# -------------------------
+async def lookup_user_message(user_message: str, normalized: str) -> Tuple[Optional[Tuple[str, str, bool]], Optional[np.ndarray]]:
+    """
+    Replies that need no Gemini call: greeting, self-introduction and cache lookup.
+    Returns ((mood, response_text, cache_hit) or None, vector).
+    """
     if not user_message or not user_message.strip():
         raise HTTPException(status_code=400, detail="I didn't receive a clear message. Please try again.")
 
     # handle simple conversational queries
-    text_lower = user_message.lower()
-    if any(g in text_lower for g in ["hello", "hi", "hey"]):
+    first_word = normalized.split(" ", 1)[0].strip(".,!?")
+    if first_word in _GREETINGS:
         general_response = "Assalamu Alaikum! I am your Quran Mood Agent. Tell me how you're feeling, and I'll find a relevant Quranic verse for you."
-        return TelexRpcResult(
-            role="agent",
-            parts=[TelexMessagePart(type="text", text=general_response)]
+        return ("greeting", general_response, False), None
+    if _WHOAMI_RE.fullmatch(normalized):
+        introduction = (
+            "I am the Quran Mood Agent. Tell me how you're feeling, and I'll share a relevant "
+            "Quranic verse with a short explanation of how it speaks to your mood."
         )
+        return ("introduction", introduction, False), None
+
+    # answer from the cache when we've seen this (or a similar) message
+    cached, vector = await lookup_cached_response(user_message, normalized)
+    if cached:
+        return (cached[0], cached[1], True), None
+    return None, vector
+
+
+def unknown_mood_reply() -> Tuple[str, str, bool]:
+    response_text = "I couldn't understand your mood. Please try expressing it more clearly so I can find a relevant Quran quote."
+    return "unknown", response_text, False
+
+
+async def triage_user_message(user_message: str, normalized: str) -> Tuple[str, Optional[str], Optional[np.ndarray], bool]:
+    """
+    Everything before the verse step: greeting check, cache lookup and mood
+    detection. Returns (mood, response_text, vector, cache_hit), where
+    response_text is None when a verse still has to be generated for the mood.
+    """
+    reply, vector = await lookup_user_message(user_message, normalized)
+    if reply:
+        mood, response_text, cache_hit = reply
+        return mood, response_text, None, cache_hit
 
     # mood detection
-    mood = detect_mood_with_gemini(user_message)
+    mood = await detect_mood_with_gemini(normalized)
     if mood == "unknown":
-        response_text = "I couldn't understand your mood. Please try expressing it more clearly so I can find a relevant Quran quote."
-        return TelexRpcResult(
-            role="agent",
-            parts=[TelexMessagePart(type="text", text=response_text)]
-        )
+        mood, response_text, cache_hit = unknown_mood_reply()
+        return mood, response_text, None, cache_hit
+
+    return mood, None, vector, False
+
+
+async def process_user_message(user_message: str) -> Tuple[str, str, bool]:
+    """
+    Shared pipeline for the JSON endpoints. Returns (mood, response_text, cache_hit).
+    The mood, verse and explanation come back from a single Gemini call.
+    """
+    normalized = normalize_text(user_message)
+    reply, vector = await lookup_user_message(user_message, normalized)
+    if reply:
+        return reply
+
+    try:
+        mood, verse, explanation = await ask_gemini_for_mood_and_verse(user_message, vector)
+    except Exception as e:
+        log.error("process_user_message error: %s", e)
+        return unknown_mood_reply()
+    remember_mood(message_digest(normalized), mood)
+    if mood == "unknown":
+        return unknown_mood_reply()
+
+    if verse:
+        response_text, complete = format_verse_response(verse, explanation), True
+    else:
+        response_text, complete = await explain_random_quote(mood, user_message)
+    if complete:
+        cache_response(normalized, vector, mood, response_text)
+    return mood, response_text, False
+
+
+async def stream_user_message(user_message: str, normalized: str, mood: str, response_text: Optional[str], vector: Optional[np.ndarray]):
+    """Server-sent events for /stream: the mood first, then the response as deltas."""
+    yield sse_event({"mood": mood})
+    if response_text is not None:
+        yield sse_event({"delta": response_text})
+        return
+    chunks = []
+    try:
+        verse = await pick_local_verse(mood, vector)
+        if verse is None:
+            # nothing to explain, and nothing worth caching
+            yield sse_event({"delta": NO_QUOTE_REPLY})
+            return
+        async for text in stream_smart_quran_response(mood, user_message, verse):
+            chunks.append(text)
+            yield sse_event({"delta": text})
+    except Exception as e:
+        log.error("stream_user_message error: %s", e)
+        yield sse_event({"error": "An internal error occurred while generating the response."})
+        return
+    response_text = "".join(chunks).strip()
+    if response_text:
+        cache_response(normalized, vector, mood, response_text)
+
+
+async def stream_reply(user_message: str) -> StreamingResponse:
+    normalized = normalize_text(user_message)
+    mood, response_text, vector, cache_hit = await triage_user_message(user_message, normalized)
+    return StreamingResponse(
+        stream_user_message(user_message, normalized, mood, response_text, vector),
+        media_type="text/event-stream",
+        headers=CACHE_HIT_HEADERS if cache_hit else CACHE_MISS_HEADERS,
+    )
+
+
+async def handle_message_send(params: TelexRpcParams) -> TelexRpcResult:
+    # Extract user message from TelexRpcParams: the first non-empty text part
+    parts = params.message.parts if params.message else []
+    text = next((part.text for part in parts if part.type == "text" and part.text), None)
+    user_message = await clean_html_async(text)
 
-    # get the smart response (Gemini)
-    smart_response = get_smart_quran_response(mood, user_message)
+    _, response_text, _ = await process_user_message(user_message)
     return TelexRpcResult(
         role="agent",
-        parts=[TelexMessagePart(type="text", text=smart_response)]
+        parts=[TelexMessagePart(type="text", text=response_text)]
     )
 
 # -------------------------
@@ -354,104 +1143,104 @@ async def handle_message_send(params: TelexRpcParams) -> TelexRpcResult:
 @app.post("/")
 async def handle_telex_rpc_request(request: Request):
     try:
-        request_body = await request.json()
-        pretty_log("RAW TELEX JSON-RPC PAYLOAD", request_body)
+        request_body = orjson.loads(await request.body())
+        log.debug("RAW TELEX JSON-RPC PAYLOAD: %s", request_body)
 
         rpc_request = TelexRpcRequest(**request_body)
         
         if rpc_request.jsonrpc != "2.0":
             error_data = TelexRpcError(code=-32600, message="Invalid JSON-RPC version. Must be '2.0'.")
-            return JSONResponse(status_code=400, content=TelexRpcErrorResponse(id=rpc_request.id, error=error_data).model_dump(), media_type="application/json")
+            return model_response(TelexRpcErrorResponse(id=rpc_request.id, error=error_data), status_code=400)
 
         if rpc_request.method == "message/send":
             result = await handle_message_send(rpc_request.params)
-            return JSONResponse(content=TelexRpcSuccessResponse(id=rpc_request.id, result=result).model_dump(), media_type="application/json")
+            return model_response(TelexRpcSuccessResponse(id=rpc_request.id, result=result))
         else:
             error_data = TelexRpcError(code=-32601, message="Method not found")
-            return JSONResponse(status_code=405, content=TelexRpcErrorResponse(id=rpc_request.id, error=error_data).model_dump(), media_type="application/json")
+            return model_response(TelexRpcErrorResponse(id=rpc_request.id, error=error_data), status_code=405)
 
     except HTTPException as e:
         error_data = TelexRpcError(code=e.status_code, message=e.detail)
-        return JSONResponse(status_code=e.status_code, content=TelexRpcErrorResponse(id=request_body.get("id", None), error=error_data).model_dump(), media_type="application/json")
+        return model_response(TelexRpcErrorResponse(id=request_body.get("id", None), error=error_data), status_code=e.status_code)
     except Exception as e:
-        print("Unhandled exception in /:", e)
+        log.exception("Unhandled exception in /")
         error_data = TelexRpcError(code=500, message="An internal error occurred while processing your request.")
-        return JSONResponse(status_code=500, content=TelexRpcErrorResponse(id=request_body.get("id", None), error=error_data).model_dump(), media_type="application/json")
+        return model_response(TelexRpcErrorResponse(id=request_body.get("id", None), error=error_data), status_code=500)
 
 @app.post("/agent")
 async def agent_endpoint(request: Request):
     # This endpoint will now serve generic non-Telex requests
     is_a2a_request: bool = False # Initialize here to ensure it's always bound
     try:
-        request_body = await request.json()
-        pretty_log("RAW GENERIC PAYLOAD", request_body)
+        request_body = orjson.loads(await request.body())
+        log.debug("RAW GENERIC PAYLOAD: %s", request_body)
 
-        user_message = ""
         # request_id = "generated-req-id" # Not needed for generic response
         # thread_id = "generated-thread-id" # Not needed for generic response
 
-        # Try structured parses first
-        parsed = False
-        # 1) TelexInputMessage shape (for generic compatibility)
-        try:
-            tin = TelexInputMessage(**request_body)
-            if tin.content:
-                user_message = clean_html_text(tin.content)
-                parsed = True
-        except Exception:
-            pass
-
-        # 2) SimpleMessageInput (for generic compatibility)
-        if not parsed:
-            try:
-                sim = SimpleMessageInput(**request_body)
-                user_message = clean_html_text(sim.message)
-                parsed = True
-            except Exception:
-                pass
-
-        # 3) Generic extractor fallback
-        if not parsed:
-            user_message = extract_user_message_generic(request_body)
-
-        if not user_message or not user_message.strip():
-            raise HTTPException(status_code=400, detail="I didn't receive a clear message. Please try again.")
-
-        # handle simple conversational queries
-        text_lower = user_message.lower()
-        if any(g in text_lower for g in ["hello", "hi", "hey"]):
-            general_response = "Assalamu Alaikum! I am your Quran Mood Agent. Tell me how you're feeling, and I'll find a relevant Quranic verse for you."
-            return JSONResponse(content=GenericResponse(response=general_response, mood="greeting").model_dump(), media_type="application/json")
-
-        # mood detection
-        mood = detect_mood_with_gemini(user_message)
-        if mood == "unknown":
-            response_text = "I couldn't understand your mood. Please try expressing it more clearly so I can find a relevant Quran quote."
-            return JSONResponse(content=GenericResponse(response=response_text, mood="unknown").model_dump(), media_type="application/json")
-
-        # get the smart response (Gemini)
-        smart_response = get_smart_quran_response(mood, user_message)
-        return JSONResponse(content=GenericResponse(response=smart_response, mood=mood).model_dump(), media_type="application/json")
+        user_message = await extract_agent_message(request_body)
+        # clients that accept server-sent events get the same stream as /stream
+        if "text/event-stream" in request.headers.get("accept", ""):
+            return await stream_reply(user_message)
+
+        mood, response_text, cache_hit = await process_user_message(user_message)
+        headers = CACHE_HIT_HEADERS if cache_hit else CACHE_MISS_HEADERS
+        return model_response(GenericResponse(response=response_text, mood=mood), headers=headers)
 
     except HTTPException as e:
         error_detail = e.detail
         status_code = e.status_code
-        return JSONResponse(status_code=status_code, content={"error": error_detail, "code": status_code}, media_type="application/json")
+        return ORJSONResponse(status_code=status_code, content={"error": error_detail, "code": status_code})
+
+    except Exception as e:
+        log.exception("Unhandled exception in /agent")
+        error_detail = "An internal error occurred while processing your request."
+        return ORJSONResponse(status_code=500, content={"error": error_detail, "code": 500})
+
+
+@app.post("/stream")
+async def stream_endpoint(request: Request):
+    # Same payloads as /agent, but the response arrives as server-sent events
+    try:
+        request_body = orjson.loads(await request.body())
+        log.debug("RAW STREAM PAYLOAD: %s", request_body)
+
+        user_message = await extract_agent_message(request_body)
+        return await stream_reply(user_message)
+
+    except HTTPException as e:
+        return ORJSONResponse(status_code=e.status_code, content={"error": e.detail, "code": e.status_code})
 
     except Exception as e:
-        print("Unhandled exception in /agent:", e)
+        log.exception("Unhandled exception in /stream")
         error_detail = "An internal error occurred while processing your request."
-        return JSONResponse(status_code=500, content={"error": error_detail, "code": 500}, media_type="application/json")
+        return ORJSONResponse(status_code=500, content={"error": error_detail, "code": 500})
 
 
 @app.get("/")
 async def home():
-    return {"status": "running", "service": "Quran Mood Agent"}
+    return Response(content=HEALTH_BODY, media_type="application/json", headers=HEALTH_HEADERS)
 
 
 # -------------------------
-# Run (for local testing)
+# Run
 # -------------------------
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("app:app", host="0.0.0.0", port=5000, reload=True)
+    if sys.argv[1:] == ["prepare"]:
+        # build the verse files once, e.g. before starting gunicorn workers
+        asyncio.run(prepare_verse_files())
+    elif DEBUG:
+        # local testing: single process with auto-reload
+        uvicorn.run("app:app", host="0.0.0.0", port=5000, reload=True)
+    else:
+        # One process per core. Each worker has its own HTTP client, verse pool
+        # and caches; share the caches through an external store (e.g. Redis) if needed.
+        workers = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+        if workers > 1:
+            # workers are fresh processes that load the verse files from disk,
+            # so build them here rather than once per worker
+            asyncio.run(prepare_verse_files())
+        # "auto" picks uvloop and httptools where they're installed (not on Windows)
+        uvicorn.run("app:app", host="0.0.0.0", port=5000, loop="auto", http="auto", workers=workers,
+                    log_level=LOG_LEVEL)